@@ -204,10 +204,8 @@ class ActorState:
         :return: dictionary with auxiliary information about the trajectory
         """
 
-        t_id = f'{self.curr_policy_id}_{self.worker_idx}_{self.split_idx}_{self.env_idx}_{self.agent_idx}_{self.num_trajectories}'
-        traj_dict = dict(
-            t_id=t_id, length=rollout_step, env_steps=self.rollout_env_steps, policy_id=self.curr_policy_id,
-        )
+        # the trajectory data itself is already in the shared buffers, here we only send the metadata
+        traj_dict = dict(length=rollout_step, env_steps=self.rollout_env_steps, policy_id=self.curr_policy_id)
 
         self.num_trajectories += 1
         self.rollout_env_steps = 0
@@ -717,19 +715,22 @@ class ActorWorker:
         env_runner = self.env_runners[split_idx]
         env_runner.traj_tensors_available[:, :, traj_buffer_idx] = 0
 
+        # group rollouts by policy, the learner gets per-rollout arrays instead of a list of dicts
+        rollout_keys = ('env_idx', 'agent_idx', 'length', 'env_steps')
         rollouts_per_policy = dict()
         for rollout in rollouts:
             policy_id = rollout['policy_id']
             if policy_id not in rollouts_per_policy:
-                rollouts_per_policy[policy_id] = dict(
-                    rollouts=[], worker_idx=self.worker_idx,
-                    split_idx=split_idx, traj_buffer_idx=traj_buffer_idx,
-                )
+                rollouts_per_policy[policy_id] = {key: [] for key in rollout_keys}
 
-            rollouts_per_policy[policy_id]['rollouts'].append(rollout)
+            policy_rollouts = rollouts_per_policy[policy_id]
+            for key in rollout_keys:
+                policy_rollouts[key].append(rollout[key])
 
-        for policy_id, rollouts in rollouts_per_policy.items():
-            self.learner_queues[policy_id].put((TaskType.TRAIN, rollouts))
+        for policy_id, policy_rollouts in rollouts_per_policy.items():
+            data = {key: np.array(values, dtype=np.int64) for key, values in policy_rollouts.items()}
+            data.update(worker_idx=self.worker_idx, split_idx=split_idx, traj_buffer_idx=traj_buffer_idx)
+            self.learner_queues[policy_id].put((TaskType.TRAIN, data))
 
     def _report_stats(self, stats):
         for report in stats:
@@ -462,6 +462,12 @@ class APPO(ReinforcementLearningAlgorithm):
     def process_report(self, report):
         """Process stats from various types of workers."""
 
+        if isinstance(report, list):
+            # some workers (e.g. learners) send their reports in batches
+            for r in report:
+                self.process_report(r)
+            return
+
         if 'policy_id' in report:
             policy_id = report['policy_id']
 
@@ -165,6 +165,53 @@ def memory_stats(process, device):
     return stats
 
 
+class CudaCacheMonitor:
+    """
+    Decides when it is worth releasing the memory cached by the PyTorch CUDA allocator.
+    With fixed batch shapes the amount of reserved memory quickly reaches a steady state and cached blocks are
+    reused, so we release the cache only when a lot of reserved memory is not actually allocated (fragmentation),
+    and the reserved memory is above the steady-state baseline (or close to the device limit) for a number of
+    consecutive training steps.
+    """
+
+    def __init__(
+        self, total_memory, warmup_steps=20, persistent_steps=10, max_unused_fraction=0.1, baseline_margin=1.2,
+    ):
+        self.total_memory = total_memory
+        self.warmup_steps = warmup_steps
+        self.persistent_steps = persistent_steps
+        self.max_unused_fraction = max_unused_fraction
+        self.baseline_margin = baseline_margin
+
+        self.num_steps = 0
+        self.baseline_reserved = 0
+        self.num_steps_over_threshold = 0
+
+    def should_release_cache(self, reserved, allocated):
+        """Call this after every training step, with the current amounts of reserved and allocated memory."""
+        self.num_steps += 1
+
+        if self.num_steps <= self.warmup_steps:
+            # reserved memory grows during the first steps, until we have cached blocks for all the tensor shapes
+            self.baseline_reserved = max(self.baseline_reserved, reserved)
+            return False
+
+        fragmented = reserved - allocated > self.max_unused_fraction * self.total_memory
+        over_baseline = reserved > self.baseline_margin * self.baseline_reserved
+        near_memory_limit = reserved > 0.8 * self.total_memory
+
+        if fragmented and (over_baseline or near_memory_limit):
+            self.num_steps_over_threshold += 1
+        else:
+            self.num_steps_over_threshold = 0
+
+        if self.num_steps_over_threshold >= self.persistent_steps:
+            self.num_steps_over_threshold = 0
+            return True
+
+        return False
+
+
 def tensor_batch_size(tensor_batch):
     for _, _, v in iterate_recursively(tensor_batch):
         return v.shape[0]
@@ -174,10 +221,13 @@ class TensorBatcher:
     def __init__(self, batch_pool):
         self.batch_pool = batch_pool
 
-    def cat(self, dict_of_tensor_arrays, macro_batch_size, use_pinned_memory, timing):
+    def cat(self, trajectory_tensors, trajectory_indices, macro_batch_size, use_pinned_memory, timing):
         """
         Here 'macro_batch' is the overall size of experience per iteration.
         Macro-batch = mini-batch * num_batches_per_iteration
+
+        Gathers the trajectories with the given indices from the (nested) dictionary of trajectory tensors
+        of shape [num_trajectories, rollout, ...] into a single macro-batch, using a single op per tensor.
         """
 
         tensor_batch = self.batch_pool.get()
@@ -192,21 +242,21 @@ class TensorBatcher:
                 tensor_batch = None
 
         if tensor_batch is None:
-            tensor_batch = copy_dict_structure(dict_of_tensor_arrays)
+            tensor_batch = copy_dict_structure(trajectory_tensors)
             log.info('Allocating new CPU tensor batch (could not get from the pool)')
 
-            for d1, cache_d, key, tensor_arr, _ in iter_dicts_recursively(dict_of_tensor_arrays, tensor_batch):
-                cache_d[key] = torch.cat(tensor_arr, dim=0)
-                if use_pinned_memory:
-                    cache_d[key] = cache_d[key].pin_memory()
-        else:
-            with timing.add_time('batcher_mem'):
-                for d1, cache_d, key, tensor_arr, cache_t in iter_dicts_recursively(dict_of_tensor_arrays, tensor_batch):
-                    offset = 0
-                    for t in tensor_arr:
-                        first_dim = t.shape[0]
-                        cache_t[offset:offset + first_dim].copy_(t)
-                        offset += first_dim
+            # allocate the entire macro-batch at once (directly in pinned memory if needed), so that the
+            # trajectories can be gathered straight into it
+            for d1, cache_d, key, t, _ in iter_dicts_recursively(trajectory_tensors, tensor_batch):
+                cache_d[key] = torch.empty(
+                    (macro_batch_size, ) + t.shape[2:], dtype=t.dtype, pin_memory=use_pinned_memory,
+                )
+
+        with timing.add_time('batcher_mem'):
+            num_trajectories = len(trajectory_indices)
+            for d1, cache_d, key, t, cache_t in iter_dicts_recursively(trajectory_tensors, tensor_batch):
+                assert num_trajectories * t.shape[1] == macro_batch_size
+                torch.index_select(t, 0, trajectory_indices, out=cache_t.view(num_trajectories, *t.shape[1:]))
 
         return tensor_batch
 
@@ -6,7 +6,7 @@ import threading
 import time
 from collections import OrderedDict, deque
 from os.path import join
-from queue import Empty, Queue, Full
+from queue import Empty, Queue, Full, SimpleQueue
 from threading import Thread
 
 import numpy as np
@@ -19,16 +19,42 @@ if os.name == 'nt':
 else:
     from faster_fifo import Queue as MpQueue
 
-from algorithms.appo.appo_utils import TaskType, list_of_dicts_to_dict_of_lists, memory_stats, cuda_envvars_for_policy, \
-    TensorBatcher, iter_dicts_recursively, copy_dict_structure, ObjectPool
+from algorithms.appo.appo_utils import TaskType, memory_stats, cuda_envvars_for_policy, \
+    TensorBatcher, iter_dicts_recursively, iterate_recursively, copy_dict_structure, ObjectPool, CudaCacheMonitor
 from algorithms.appo.model import create_actor_critic
 from algorithms.appo.population_based_training import PbtTask
 from algorithms.utils.action_distributions import get_action_distribution
-from algorithms.utils.algo_utils import calculate_gae, EPS
-from algorithms.utils.pytorch_utils import to_scalar
+from algorithms.utils.algo_utils import EPS
+from algorithms.utils.pytorch_utils import to_cpu_copy
 from utils.decay import LinearDecay
 from utils.timing import Timing
-from utils.utils import log, AttrDict, experiment_dir, ensure_dir_exists, join_or_kill, safe_get
+from utils.utils import log, AttrDict, experiment_dir, ensure_dir_exists, join_or_kill, SlidingWindowStats
+
+
+class Rollouts:
+    """
+    Rollouts received by the learner, stored as arrays (one element per rollout) rather than a list of dicts.
+    traj_idx is the index of the trajectory in the flattened shared trajectory tensors.
+    """
+
+    def __init__(self, traj_idx=None, length=None, env_steps=None):
+        self.traj_idx = np.empty(0, dtype=np.int64) if traj_idx is None else traj_idx
+        self.length = np.empty(0, dtype=np.int64) if length is None else length
+        self.env_steps = np.empty(0, dtype=np.int64) if env_steps is None else env_steps
+
+    def __len__(self):
+        return len(self.traj_idx)
+
+    def extend(self, other):
+        self.traj_idx = np.concatenate((self.traj_idx, other.traj_idx))
+        self.length = np.concatenate((self.length, other.length))
+        self.env_steps = np.concatenate((self.env_steps, other.env_steps))
+
+    def split(self, n):
+        """Returns first n rollouts and the rest."""
+        first = Rollouts(self.traj_idx[:n], self.length[:n], self.env_steps[:n])
+        rest = Rollouts(self.traj_idx[n:], self.length[n:], self.env_steps[n:])
+        return first, rest
 
 
 class LearnerWorker:
@@ -54,7 +80,19 @@ class LearnerWorker:
         self.obs_space = obs_space
         self.action_space = action_space
 
-        self.rollout_tensors = shared_buffers.tensor_trajectories
+        # shared trajectory tensors viewed as [num_trajectory_buffers, rollout, ...], i.e. with the worker, split,
+        # env, agent, and trajectory buffer dimensions flattened, so we can gather the training batch from them
+        # directly, with a single op per tensor
+        self.traj_buffers_shape = shared_buffers.tensor_dimensions()[:-1]
+        self.traj_tensors = AttrDict(copy_dict_structure(shared_buffers.tensors))
+        for _, d, key, t, _ in iter_dicts_recursively(shared_buffers.tensors, self.traj_tensors):
+            d[key] = t.view(-1, *t.shape[len(self.traj_buffers_shape):])
+
+        # strides of the (worker, split, env, agent, traj_buffer) dimensions, to pack these indices into
+        # a single flat trajectory index
+        shape = self.traj_buffers_shape
+        self.traj_buffers_strides = [int(np.prod(shape[i + 1:])) for i in range(len(shape))]
+
         self.traj_tensors_available = shared_buffers.is_traj_tensor_available
         self.policy_versions = shared_buffers.policy_versions
         self.stop_experience_collection = shared_buffers.stop_experience_collection
@@ -63,7 +101,9 @@ class LearnerWorker:
 
         self.device = None
         self.actor_critic = None
+        self.actor_critic_params = None
         self.optimizer = None
+        self.adam_second_moments = None
         self.policy_lock = policy_lock
         self.resume_experience_collection_cv = resume_experience_collection_cv
 
@@ -80,10 +120,17 @@ class LearnerWorker:
         # we send weight updates via these queues
         self.policy_worker_queues = policy_worker_queues
 
-        self.experience_buffer_queue = Queue()
+        # a single producer (_run) and a single consumer (_train_loop) thread, so we don't need the extra locking and
+        # task tracking of queue.Queue
+        self.experience_buffer_queue = SimpleQueue()
+        # each counter is only written by one thread (producer and consumer of the experience buffers), so we
+        # know how many buffers are waiting for training without polling experience_buffer_queue.qsize()
+        self.num_buffers_enqueued = self.num_buffers_dequeued = 0
 
         self.tensor_batch_pool = ObjectPool()
         self.tensor_batcher = TensorBatcher(self.tensor_batch_pool)
+        self.buffer_copied_event = None  # marks the end of the asynchronous copy from the pinned CPU buffer
+        self.copy_stream = None  # CUDA stream used to copy experience to the device while we train on the previous batch
 
         self.with_training = True  # set to False for debugging no-training regime
         self.train_in_background = self.cfg.train_in_background_thread  # set to False for debugging
@@ -103,8 +150,25 @@ class LearnerWorker:
 
         self.last_saved_time = self.last_milestone_time = 0
 
+        # training stats are sent in batches, rather than one message per training iteration
+        self.pending_reports = []
+        self.last_reports_flush = 0
+        self.reports_flush_interval = 0.2  # seconds
+
+        # checkpoints are serialized and written to disk in a separate thread, so the training is not blocked
+        self.save_queue = Queue()
+        self.save_thread = Thread(target=self._save_loop, daemon=True)
+
+        # releasing the CUDA cache is slow, so it is done by a separate thread without blocking the training
+        self.cache_cleanup_requested = threading.Event()
+        self.cache_cleanup_after = None  # CUDA event recorded after the training step that requested the cleanup
+        self.cache_cleanup_thread = Thread(target=self._cache_cleanup_loop, daemon=True)
+
         self.discarded_experience_over_time = deque([], maxlen=30)
         self.discarded_experience_timer = time.time()
+        # the rate only changes when a new sample is added (once a second), so it is calculated right there
+        # by the _run thread, and the training thread just reads the latest value
+        self.discarding_rate = 0
         self.num_discarded_rollouts = 0
 
         self.process = Process(target=self._run, daemon=True)
@@ -122,6 +186,11 @@ class LearnerWorker:
         self.terminate = True
 
     def _broadcast_model_weights(self):
+        """
+        Called only once, after the model is initialized. The model lives in shared memory, so policy workers
+        keep a reference to these tensors and later updates are signalled only by the policy version number
+        stored in self.policy_versions (see PolicyWorker._update_weights()).
+        """
         state_dict = self.actor_critic.state_dict()
         policy_version = self.train_step
         log.debug('Broadcast model weights for model version %d', policy_version)
@@ -132,89 +201,113 @@ class LearnerWorker:
     def _calculate_gae(self, buffer):
         """
         Calculate advantages using Generalized Advantage Estimation.
-        This is leftover the from previous version of the algorithm.
-        Perhaps should be re-implemented in PyTorch tensors, similar to V-trace for uniformity.
+        Operates directly on the buffer tensors on the training device, similar to V-trace. Buffer consists of
+        complete rollouts, so all [E x T] tensors can be viewed as [T, E] without copying.
         """
 
-        rewards = torch.stack(buffer.rewards).numpy().squeeze()  # [E, T]
-        dones = torch.stack(buffer.dones).numpy().squeeze()  # [E, T]
-        values_arr = torch.stack(buffer.values).numpy().squeeze()  # [E, T]
+        rollout = self.cfg.rollout
+        gamma, gae_lambda = self.cfg.gamma, self.cfg.gae_lambda
+
+        rewards = buffer.rewards.view(-1, rollout).t()  # [E x T] -> [T, E]
+        dones = buffer.dones.view(-1, rollout).t()  # [E x T] -> [T, E]
+        values = buffer.values.view(-1, rollout).t()  # [E x T] -> [T, E]
+
+        buffer.advantages = torch.empty_like(buffer.rewards)
+        buffer.returns = torch.empty_like(buffer.rewards)
+        advantages = buffer.advantages.view(-1, rollout).t()
+        returns = buffer.returns.view(-1, rollout).t()
 
         # calculating fake values for the last step in the rollout
         # this will make sure that advantage of the very last action is always zero
-        values = []
-        for i in range(len(values_arr)):
-            last_value, last_reward = values_arr[i][-1], rewards[i, -1]
-            next_value = (last_value - last_reward) / self.cfg.gamma
-            values.append(list(values_arr[i]))
-            values[i].append(float(next_value))  # [T] -> [T+1]
+        next_values = (values[rollout - 1] - rewards[rollout - 1]) / gamma
 
         # calculating returns and GAE
-        rewards = rewards.transpose((1, 0))  # [E, T] -> [T, E]
-        dones = dones.transpose((1, 0))  # [E, T] -> [T, E]
-        values = np.asarray(values).transpose((1, 0))  # [E, T+1] -> [T+1, E]
+        next_advantages = torch.zeros_like(next_values)
+        next_returns = next_values
+        for t in reversed(range(rollout)):
+            not_done = 1.0 - dones[t]
+            delta = rewards[t] + not_done * gamma * next_values - values[t]
+            next_advantages = delta + not_done * (gamma * gae_lambda) * next_advantages
+            next_returns = rewards[t] + not_done * gamma * next_returns
+
+            advantages[t] = next_advantages
+            returns[t] = next_returns
+            next_values = values[t]
 
-        advantages, returns = calculate_gae(rewards, dones, values, self.cfg.gamma, self.cfg.gae_lambda)
+        return buffer
 
-        # transpose tensors back to [E, T] before creating a single experience buffer
-        buffer.advantages = advantages.transpose((1, 0))  # [T, E] -> [E, T]
-        buffer.returns = returns.transpose((1, 0))  # [T, E] -> [E, T]
-        buffer.returns = buffer.returns[:, :, np.newaxis]  # [E, T] -> [E, T, 1]
+    def _mark_rollout_buffers_free(self, rollouts):
+        indices = np.unravel_index(rollouts.traj_idx, self.traj_buffers_shape)
+        worker, split, env, agent, traj_buffer = (idx.tolist() for idx in indices)
 
-        buffer.advantages = [torch.tensor(buffer.advantages).reshape(-1)]
-        buffer.returns = [torch.tensor(buffer.returns).reshape(-1)]
+        # group the rollouts by worker and split, so we need only one indexing op per group
+        traj_buffers = dict()
+        for i, key in enumerate(zip(worker, split)):
+            if key not in traj_buffers:
+                traj_buffers[key] = ([], [], [])
 
-        return buffer
+            env_indices, agent_indices, traj_buffer_indices = traj_buffers[key]
+            env_indices.append(env[i])
+            agent_indices.append(agent[i])
+            traj_buffer_indices.append(traj_buffer[i])
 
-    def _mark_rollout_buffer_free(self, rollout):
-        r = rollout
-        self.traj_tensors_available[r.worker_idx, r.split_idx][r.env_idx, r.agent_idx, r.traj_buffer_idx] = 1
+        for (worker_idx, split_idx), indices in traj_buffers.items():
+            self.traj_tensors_available[worker_idx, split_idx][indices] = 1
 
     def _prepare_train_buffer(self, rollouts, macro_batch_size, timing):
-        trajectories = [AttrDict(r['t']) for r in rollouts]
-
         with timing.add_time('buffers'):
-            buffer = AttrDict()
-
-            # by the end of this loop the buffer is a dictionary containing lists of numpy arrays
-            for i, t in enumerate(trajectories):
-                for key, x in t.items():
-                    if key not in buffer:
-                        buffer[key] = []
-                    buffer[key].append(x)
-
-            # convert lists of dict observations to a single dictionary of lists
-            for key, x in buffer.items():
-                if isinstance(x[0], (dict, OrderedDict)):
-                    buffer[key] = list_of_dicts_to_dict_of_lists(x)
-
-        if not self.cfg.with_vtrace:
-            with timing.add_time('calc_gae'):
-                buffer = self._calculate_gae(buffer)
+            # flat indices of the trajectory buffers, in the order of rollouts
+            traj_indices = torch.from_numpy(rollouts.traj_idx)
 
         with timing.add_time('batching'):
             # concatenate rollouts from different workers into a single batch efficiently
             # that is, if we already have memory for the buffers allocated, we can just copy the data into
             # existing cached tensors instead of creating new ones. This is a performance optimization.
             use_pinned_memory = self.cfg.device == 'gpu'
-            buffer = self.tensor_batcher.cat(buffer, macro_batch_size, use_pinned_memory, timing)
+            if self.buffer_copied_event is not None:
+                # pinned buffers are reused, make sure the previous asynchronous copy is finished before we overwrite
+                self.buffer_copied_event.synchronize()
+            buffer = self.tensor_batcher.cat(
+                self.traj_tensors, traj_indices, macro_batch_size, use_pinned_memory, timing,
+            )
 
         with timing.add_time('buff_ready'):
-            for r in rollouts:
-                self._mark_rollout_buffer_free(r)
-
-        with timing.add_time('tensors_gpu_float'):
-            device_buffer = self._copy_train_data_to_device(buffer)
-
-        with timing.add_time('squeeze'):
-            # will squeeze actions only in simple categorical case
-            tensors_to_squeeze = ['actions', 'log_prob_actions', 'policy_version', 'values', 'rewards', 'dones']
-            for tensor_name in tensors_to_squeeze:
-                device_buffer[tensor_name].squeeze_()
+            self._mark_rollout_buffers_free(rollouts)
+
+        episode_boundaries = None
+        if self.cfg.use_rnn:
+            # for every trajectory segment of length recurrence: whether RNN states have to be reset within it.
+            # Calculated here on the CPU, so the training loop can choose the BPTT path without a device sync
+            # (dones on the last step of the segment don't affect the outputs)
+            episode_boundaries = buffer.dones.view(-1, self.cfg.recurrence)[:, :-1].any(dim=1).numpy()
+
+        # copy the data to the device and calculate advantages on a separate CUDA stream, so these ops can overlap
+        # with the training on the previous batch (no-op on CPU)
+        with torch.cuda.stream(self.copy_stream):
+            with timing.add_time('tensors_gpu_float'):
+                device_buffer = self._copy_train_data_to_device(buffer)
+
+            with timing.add_time('squeeze'):
+                # will squeeze actions only in simple categorical case
+                tensors_to_squeeze = ['actions', 'log_prob_actions', 'policy_version', 'values', 'rewards', 'dones']
+                for tensor_name in tensors_to_squeeze:
+                    device_buffer[tensor_name].squeeze_()
+
+            if not self.cfg.with_vtrace:
+                with timing.add_time('calc_gae'):
+                    device_buffer = self._calculate_gae(device_buffer)
+
+            buffer_ready_event = None
+            if self.copy_stream is not None:
+                buffer_ready_event = torch.cuda.Event()
+                buffer_ready_event.record()
+
+        # pinned buffers are reused, we can only overwrite this one after the asynchronous copy is finished
+        self.buffer_copied_event = buffer_ready_event
 
         # we no longer need the cached buffer, and can put it back into the pool
         self.tensor_batch_pool.put(buffer)
-        return device_buffer
+        return device_buffer, episode_boundaries, buffer_ready_event
 
     def _macro_batch_size(self, batch_size):
         return self.cfg.num_batches_per_iteration * batch_size
@@ -226,14 +319,16 @@ class LearnerWorker:
         assert self.cfg.rollout % self.cfg.recurrence == 0
         assert macro_batch_size % self.cfg.recurrence == 0
 
-        samples = env_steps = 0
-        for rollout in rollouts:
-            samples += rollout['length']
-            env_steps += rollout['env_steps']
+        samples, env_steps = int(rollouts.length.sum()), int(rollouts.env_steps.sum())
 
         with timing.add_time('prepare'):
-            buffer = self._prepare_train_buffer(rollouts, macro_batch_size, timing)
-            self.experience_buffer_queue.put((buffer, batch_size, samples, env_steps))
+            buffer, episode_boundaries, buffer_ready_event = self._prepare_train_buffer(
+                rollouts, macro_batch_size, timing,
+            )
+            self.experience_buffer_queue.put(
+                (buffer, episode_boundaries, batch_size, samples, env_steps, buffer_ready_event),
+            )
+            self.num_buffers_enqueued += 1
 
     def _process_rollouts(self, rollouts, timing):
         # batch_size can potentially change through PBT, so we should keep it the same and pass it around
@@ -245,28 +340,26 @@ class LearnerWorker:
         if len(rollouts) < rollouts_in_macro_batch:
             return rollouts
 
-        discard_rollouts = 0
-        policy_version = self.train_step
-        for r in rollouts:
-            rollout_min_version = r['t']['policy_version'].min().item()
-            if policy_version - rollout_min_version >= self.cfg.max_policy_lag:
-                discard_rollouts += 1
-                self._mark_rollout_buffer_free(r)
-            else:
-                break
+        # oldest policy version in each rollout, gathered for all pending rollouts at once
+        policy_versions = self.traj_tensors.policy_version[torch.from_numpy(rollouts.traj_idx)]
+        rollout_min_versions = policy_versions.view(len(rollouts), -1).min(dim=1)[0].numpy()
+        too_old = self.train_step - rollout_min_versions >= self.cfg.max_policy_lag
+
+        # discard old rollouts from the front of the queue, up to the first one that is recent enough
+        discard_rollouts = len(rollouts) if too_old.all() else int(np.argmin(too_old))
 
         if discard_rollouts > 0:
             log.warning(
                 'Discarding %d old rollouts, cut by policy lag threshold %d (learner %d)',
                 discard_rollouts, self.cfg.max_policy_lag, self.policy_id,
             )
-            rollouts = rollouts[discard_rollouts:]
+            discarded_rollouts, rollouts = rollouts.split(discard_rollouts)
+            self._mark_rollout_buffers_free(discarded_rollouts)
             self.num_discarded_rollouts += discard_rollouts
 
         if len(rollouts) >= rollouts_in_macro_batch:
             # process newest rollouts
-            rollouts_to_process = rollouts[:rollouts_in_macro_batch]
-            rollouts = rollouts[rollouts_in_macro_batch:]
+            rollouts_to_process, rollouts = rollouts.split(rollouts_in_macro_batch)
 
             self._process_macro_batch(rollouts_to_process, batch_size, timing)
             # log.info('Unprocessed rollouts: %d (%d samples)', len(rollouts), len(rollouts) * self.cfg.rollout)
@@ -274,26 +367,36 @@ class LearnerWorker:
         return rollouts
 
     def _get_minibatches(self, batch_size, experience_size):
-        """Generating minibatches for training."""
+        """
+        Generating minibatches for training.
+        Returns a list of (indices, segments), where indices select the minibatch samples on the training device,
+        and segments are the indices of the mini-trajectories (of length recurrence) in the minibatch, on the CPU.
+        """
         assert self.cfg.rollout % self.cfg.recurrence == 0
         assert experience_size % batch_size == 0, f'experience size: {experience_size}, batch size: {batch_size}'
 
         if self.cfg.num_batches_per_iteration == 1:
-            return [None]  # single minibatch is actually the entire buffer, we don't need indices
+            # single minibatch is actually the entire buffer, we don't need indices
+            return [(None, None)]
 
-        # indices that will start the mini-trajectories from the same episode (for bptt)
-        indices = np.arange(0, experience_size, self.cfg.recurrence)
-        indices = np.random.permutation(indices)
+        # mini-trajectories from the same episode (for bptt), in random order
+        recurrence = self.cfg.recurrence
+        segments = torch.randperm(experience_size // recurrence)
+
+        # only the start indices are copied to the device (once per epoch), complete indices are generated there
+        segment_starts = segments * recurrence
+        if self.device.type == 'cuda':
+            segment_starts = segment_starts.pin_memory()
+        segment_starts = segment_starts.to(self.device, non_blocking=True)
 
         # complete indices of mini trajectories, e.g. with recurrence==4: [4, 16] -> [4, 5, 6, 7, 16, 17, 18, 19]
-        indices = [np.arange(i, i + self.cfg.recurrence) for i in indices]
-        indices = np.concatenate(indices)
+        indices = (segment_starts.view(-1, 1) + torch.arange(recurrence, device=self.device)).view(-1)
 
         assert len(indices) == experience_size
 
-        num_minibatches = experience_size // batch_size
-        minibatches = np.split(indices, num_minibatches)
-        return minibatches
+        minibatches = torch.split(indices, batch_size)
+        minibatch_segments = torch.split(segments, batch_size // recurrence)
+        return [(indices, segments.numpy()) for indices, segments in zip(minibatches, minibatch_segments)]
 
     @staticmethod
     def _get_minibatch(buffer, indices):
@@ -307,9 +410,9 @@ class LearnerWorker:
             if isinstance(x, (dict, OrderedDict)):
                 mb[item] = AttrDict()
                 for key, x_elem in x.items():
-                    mb[item][key] = x_elem[indices]
+                    mb[item][key] = x_elem.index_select(0, indices)
             else:
-                mb[item] = x[indices]
+                mb[item] = x.index_select(0, indices)
 
         return mb
 
@@ -326,11 +429,11 @@ class LearnerWorker:
         self._maybe_save()
 
     def _maybe_save(self):
-        if time.time() - self.last_saved_time >= self.cfg.save_every_sec or self.should_save_model:
-            self._save()
-            self.model_saved_event.set()
+        now = time.time()
+        if now - self.last_saved_time >= self.cfg.save_every_sec or self.should_save_model:
+            self._save()  # model_saved_event is set by the save thread once the checkpoint is on disk
             self.should_save_model = False
-            self.last_saved_time = time.time()
+            self.last_saved_time = now
 
     @staticmethod
     def checkpoint_dir(cfg, policy_id):
@@ -355,29 +458,61 @@ class LearnerWorker:
         checkpoint = self._get_checkpoint_dict()
         assert checkpoint is not None
 
-        checkpoint_dir = self.checkpoint_dir(self.cfg, self.policy_id)
-        tmp_filepath = join(checkpoint_dir, '.temp_checkpoint')
+        # copy the state to CPU memory right away, because the training will keep updating the parameters
+        # while the checkpoint is being serialized. On GPU we queue all the copies asynchronously and wait for
+        # them once, instead of doing a blocking device-to-host copy for every tensor
+        on_gpu = self.device.type == 'cuda'
+        checkpoint = to_cpu_copy(checkpoint, non_blocking=on_gpu)
+        if on_gpu:
+            torch.cuda.current_stream(self.device).synchronize()
+
         checkpoint_name = f'checkpoint_{self.train_step:09d}_{self.env_steps}.pth'
+        self.save_queue.put((checkpoint, checkpoint_name))
+
+    def _save_loop(self):
+        while True:
+            task = self.save_queue.get()
+            if task is None:
+                break
+
+            checkpoint, checkpoint_name = task
+            try:
+                self._save_to_disk(checkpoint, checkpoint_name)
+            except Exception:
+                log.exception('Could not save checkpoint %s (learner %d)', checkpoint_name, self.policy_id)
+
+            self.model_saved_event.set()
+
+    def _save_to_disk(self, checkpoint, checkpoint_name):
+        checkpoint_dir = self.checkpoint_dir(self.cfg, self.policy_id)
+        tmp_filepath = join(checkpoint_dir, '.temp_checkpoint.pth')
         filepath = join(checkpoint_dir, checkpoint_name)
         log.info('Saving %s...', tmp_filepath)
-        torch.save(checkpoint, tmp_filepath)
+        torch.save(checkpoint, tmp_filepath, _use_new_zipfile_serialization=True)
         log.info('Renaming %s to %s', tmp_filepath, filepath)
         os.rename(tmp_filepath, filepath)
 
-        while len(self.get_checkpoints(checkpoint_dir)) > self.cfg.keep_checkpoints:
-            oldest_checkpoint = self.get_checkpoints(checkpoint_dir)[0]
+        checkpoints = self.get_checkpoints(checkpoint_dir)
+        while len(checkpoints) > self.cfg.keep_checkpoints:
+            oldest_checkpoint = checkpoints.pop(0)
             if os.path.isfile(oldest_checkpoint):
                 log.debug('Removing %s', oldest_checkpoint)
                 os.remove(oldest_checkpoint)
 
         if self.cfg.save_milestones_sec > 0:
             # milestones enabled
-            if time.time() - self.last_milestone_time >= self.cfg.save_milestones_sec:
+            now = time.time()
+            if now - self.last_milestone_time >= self.cfg.save_milestones_sec:
                 milestones_dir = ensure_dir_exists(join(checkpoint_dir, 'milestones'))
                 milestone_path = join(milestones_dir, f'{checkpoint_name}.milestone')
                 log.debug('Saving a milestone %s', milestone_path)
                 shutil.copy(filepath, milestone_path)
-                self.last_milestone_time = time.time()
+                self.last_milestone_time = now
+
+    def _stop_save_thread(self):
+        if self.save_thread.is_alive():
+            self.save_queue.put(None)
+            self.save_thread.join()
 
     @staticmethod
     def _policy_loss(ratio, adv, clip_ratio_low, clip_ratio_high):
@@ -402,7 +537,7 @@ class LearnerWorker:
     def _prepare_observations(self, obs_tensors, gpu_buffer_obs):
         for d, gpu_d, k, v, _ in iter_dicts_recursively(obs_tensors, gpu_buffer_obs):
             device, dtype = self.actor_critic.device_and_type_for_input_tensor(k)
-            tensor = v.detach().to(device, copy=True).type(dtype)
+            tensor = v.detach().to(device, copy=True, non_blocking=True).type(dtype)
             gpu_d[k] = tensor
 
     def _copy_train_data_to_device(self, buffer):
@@ -417,18 +552,13 @@ class LearnerWorker:
 
         return device_buffer
 
-    def _train(self, gpu_buffer, batch_size, experience_size, timing):
+    def _train(self, gpu_buffer, episode_boundaries, batch_size, experience_size, timing):
         with torch.no_grad():
             early_stopping_tolerance = 1e-6
             early_stop = False
             prev_epoch_actor_loss = 1e9
             epoch_actor_losses = []
-
-            # V-trace parameters
-            # noinspection PyArgumentList
-            rho_hat = torch.Tensor([self.cfg.vtrace_rho])
-            # noinspection PyArgumentList
-            c_hat = torch.Tensor([self.cfg.vtrace_c])
+            epoch_max_abs_loss = high_loss_mb = None
 
             clip_ratio_high = 1.0 + self.cfg.ppo_clip_ratio  # e.g. 1.1
             # this still works with e.g. clip_ratio = 2, while PPO's 1-r would give negative ratio
@@ -453,13 +583,13 @@ class LearnerWorker:
                 if early_stop or self.terminate:
                     break
 
-                summary_this_epoch = force_summaries = False
+                summary_this_epoch = False
 
                 minibatches = self._get_minibatches(batch_size, experience_size)
 
             for batch_num in range(len(minibatches)):
                 with timing.add_time('minibatch_init'):
-                    indices = minibatches[batch_num]
+                    indices, segments = minibatches[batch_num]
 
                     # current minibatch consisting of short trajectory segments with length == recurrence
                     mb = self._get_minibatch(gpu_buffer, indices)
@@ -471,30 +601,45 @@ class LearnerWorker:
                 # initial rnn states
                 with timing.add_time('bptt_initial'):
                     rnn_states = mb.rnn_states[::recurrence]
-                    is_same_episode = 1.0 - mb.dones.unsqueeze(dim=1)
 
-                # calculate RNN outputs for each timestep in a loop
-                with timing.add_time('bptt'):
-                    core_outputs = []
-                    for i in range(recurrence):
-                        # indices of head outputs corresponding to the current timestep
-                        step_head_outputs = head_outputs[i::recurrence]
+                    # reorder [Batch x T, ...] tensors to [T, Batch, ...] once, so every timestep below is
+                    # a contiguous slice instead of a strided one
+                    num_trajectories = head_outputs.shape[0] // recurrence
+                    head_outputs_tn = head_outputs.view(num_trajectories, recurrence, -1).transpose(0, 1).contiguous()
+                    is_same_episode = 1.0 - mb.dones.view(num_trajectories, recurrence, 1).transpose(0, 1).contiguous()
 
+                with timing.add_time('bptt'):
+                    # RNN states only need to be reset on episode boundaries, dones on the last step of the
+                    # trajectory don't affect the outputs
+                    use_sequence_core = True
+                    if episode_boundaries is not None:
+                        mb_boundaries = episode_boundaries if segments is None else episode_boundaries[segments]
+                        use_sequence_core = not mb_boundaries.any()
+
+                    if use_sequence_core:
+                        # no episode boundaries within this minibatch, process the whole sequence in one call
                         with timing.add_time('bptt_forward_core'):
-                            core_output, rnn_states = self.actor_critic.forward_core(step_head_outputs, rnn_states)
-                            core_outputs.append(core_output)
+                            core_outputs = self.actor_critic.forward_core_sequence(head_outputs_tn, rnn_states)
+                    else:
+                        # calculate RNN outputs for each timestep in a loop
+                        core_outputs = []
+                        for i in range(recurrence):
+                            # head outputs corresponding to the current timestep
+                            step_head_outputs = head_outputs_tn[i]
+
+                            with timing.add_time('bptt_forward_core'):
+                                core_output, rnn_states = self.actor_critic.forward_core(step_head_outputs, rnn_states)
+                                core_outputs.append(core_output)
 
-                        if self.cfg.use_rnn:
                             # zero-out RNN states on the episode boundary
                             with timing.add_time('bptt_rnn_states'):
-                                is_same_episode_step = is_same_episode[i::recurrence]
-                                rnn_states = rnn_states * is_same_episode_step
+                                rnn_states = rnn_states * is_same_episode[i]
+
+                        core_outputs = torch.stack(core_outputs)
 
                 with timing.add_time('tail'):
                     # transform core outputs from [T, Batch, D] to [Batch, T, D] and then to [Batch x T, D]
                     # which is the same shape as the minibatch
-                    core_outputs = torch.stack(core_outputs)
-
                     num_timesteps, num_trajectories = core_outputs.shape[:2]
                     assert num_timesteps == recurrence
                     assert num_timesteps * num_trajectories == batch_size
@@ -513,50 +658,53 @@ class LearnerWorker:
 
                     values = result.values.squeeze()
 
-                with torch.no_grad():  # these computations are not the part of the computation graph
-                    if self.cfg.with_vtrace:
-                        ratios_cpu = ratio.cpu()
-                        values_cpu = values.cpu()
-                        rewards_cpu = mb.rewards.cpu()  # we only need this on CPU, potential minor optimization
-                        dones_cpu = mb.dones.cpu()
-
-                        vtrace_rho = torch.min(rho_hat, ratios_cpu)
-                        vtrace_c = torch.min(c_hat, ratios_cpu)
-
-                        vs = torch.zeros((num_trajectories * recurrence))
-                        adv = torch.zeros((num_trajectories * recurrence))
-
-                        next_values = (values_cpu[recurrence - 1::recurrence] - rewards_cpu[recurrence - 1::recurrence]) / gamma
-                        next_vs = next_values
-
-                        with timing.add_time('vtrace'):
-                            for i in reversed(range(self.cfg.recurrence)):
-                                rewards = rewards_cpu[i::recurrence]
-                                dones = dones_cpu[i::recurrence]
-                                not_done = 1.0 - dones
-                                not_done_times_gamma = not_done * gamma
-
-                                curr_values = values_cpu[i::recurrence]
-                                curr_vtrace_rho = vtrace_rho[i::recurrence]
-                                curr_vtrace_c = vtrace_c[i::recurrence]
-
-                                delta_s = curr_vtrace_rho * (rewards + not_done_times_gamma * next_values - curr_values)
-                                adv[i::recurrence] = curr_vtrace_rho * (rewards + not_done_times_gamma * next_vs - curr_values)
-                                next_vs = curr_values + delta_s + not_done_times_gamma * curr_vtrace_c * (next_vs - next_values)
-                                vs[i::recurrence] = next_vs
-
-                                next_values = curr_values
-
-                        targets = vs
-                    else:
-                        # using regular GAE
-                        adv = mb.advantages
-                        targets = mb.returns
-
-                    adv_mean = adv.mean()
-                    adv_std = adv.std()
-                    adv = (adv - adv_mean) / max(1e-3, adv_std)  # normalize advantage
-                    adv = adv.to(self.device)
+                # V-trace targets and advantages are not the part of the computation graph, so we work with
+                # detached tensors instead of entering a no_grad() region on every minibatch
+                if self.cfg.with_vtrace:
+                    # minibatch consists of trajectory segments of length == recurrence,
+                    # so we can view the tensors as [T, N] without copying them to the CPU
+                    ratios_tn = ratio.detach().view(num_trajectories, recurrence).t()
+                    values_tn = values.detach().view(num_trajectories, recurrence).t()
+                    rewards_tn = mb.rewards.view(num_trajectories, recurrence).t()
+                    dones_tn = mb.dones.view(num_trajectories, recurrence).t()
+
+                    vtrace_rho = torch.clamp(ratios_tn, max=self.cfg.vtrace_rho)  # min(rho_hat, ratio)
+                    vtrace_c = torch.clamp(ratios_tn, max=self.cfg.vtrace_c)  # min(c_hat, ratio)
+
+                    vs = torch.zeros((recurrence, num_trajectories), device=self.device)
+                    adv = torch.zeros((recurrence, num_trajectories), device=self.device)
+
+                    next_values = (values_tn[recurrence - 1] - rewards_tn[recurrence - 1]) / gamma
+                    next_vs = next_values
+
+                    with timing.add_time('vtrace'):
+                        for i in reversed(range(recurrence)):
+                            rewards = rewards_tn[i]
+                            not_done = 1.0 - dones_tn[i]
+                            not_done_times_gamma = not_done * gamma
+
+                            curr_values = values_tn[i]
+                            curr_vtrace_rho = vtrace_rho[i]
+                            curr_vtrace_c = vtrace_c[i]
+
+                            delta_s = curr_vtrace_rho * (rewards + not_done_times_gamma * next_values - curr_values)
+                            adv[i] = curr_vtrace_rho * (rewards + not_done_times_gamma * next_vs - curr_values)
+                            next_vs = curr_values + delta_s + not_done_times_gamma * curr_vtrace_c * (next_vs - next_values)
+                            vs[i] = next_vs
+
+                            next_values = curr_values
+
+                    # [T, N] -> [N, T] -> [B], same layout as the rest of the minibatch
+                    targets = vs.t().reshape(-1)
+                    adv = adv.t().reshape(-1)
+                else:
+                    # using regular GAE
+                    adv = mb.advantages
+                    targets = mb.returns
+
+                # normalize advantage, std and mean are computed in a single pass and without a device sync
+                adv_std, adv_mean = torch.std_mean(adv)
+                adv = (adv - adv_mean).div_(adv_std.clamp(min=1e-3))
 
                 with timing.add_time('losses'):
                     policy_loss = self._policy_loss(ratio, adv, clip_ratio_low, clip_ratio_high)
@@ -568,31 +716,41 @@ class LearnerWorker:
                         entropy_loss = 0.0
 
                     actor_loss = policy_loss + entropy_loss
-                    epoch_actor_losses.append(actor_loss.item())
+                    epoch_actor_losses.append(actor_loss.detach())  # stays on the device, no sync
 
-                    targets = targets.to(self.device)
                     old_values = mb.values
                     value_loss = self._value_loss(values, old_values, targets, clip_value)
                     critic_loss = value_loss
 
                     loss = actor_loss + critic_loss
 
-                    high_loss = 30.0
-                    if abs(to_scalar(policy_loss)) > high_loss or abs(to_scalar(value_loss)) > high_loss or abs(to_scalar(entropy_loss)) > high_loss:
-                        log.warning(
-                            'High loss value: %.4f %.4f %.4f %.4f (recommended to adjust the --reward_scale parameter)',
-                            to_scalar(loss), to_scalar(policy_loss), to_scalar(value_loss), to_scalar(entropy_loss),
+                    # keep the losses and advantages of the minibatch with the largest absolute loss component in
+                    # this epoch, entirely on the device. The largest loss is checked once at the end of the epoch
+                    if not torch.is_tensor(entropy_loss):
+                        entropy_loss = torch.zeros_like(policy_loss)
+                    mb_losses = torch.stack([loss, policy_loss, value_loss, entropy_loss, adv_std]).detach()
+                    mb_max_abs_loss = mb_losses[1:4].abs().max()
+                    if epoch_max_abs_loss is None:
+                        epoch_max_abs_loss, high_loss_mb = mb_max_abs_loss, (mb_losses, adv.detach())
+                    else:
+                        is_new_max = mb_max_abs_loss > epoch_max_abs_loss
+                        epoch_max_abs_loss = torch.max(epoch_max_abs_loss, mb_max_abs_loss)
+                        high_loss_mb = (
+                            torch.where(is_new_max, mb_losses, high_loss_mb[0]),
+                            torch.where(is_new_max, adv.detach(), high_loss_mb[1]),
                         )
-                        force_summaries = True
 
                 with timing.add_time('update'):
                     # update the weights
                     self.optimizer.zero_grad()
                     loss.backward()
 
+                    grad_norm = None
                     if self.cfg.max_grad_norm > 0.0:
                         with timing.add_time('clip'):
-                            torch.nn.utils.clip_grad_norm_(self.actor_critic.parameters(), self.cfg.max_grad_norm)
+                            grad_norm = torch.nn.utils.clip_grad_norm_(
+                                self.actor_critic_params, self.cfg.max_grad_norm,
+                            )
 
                     curr_policy_version = self.train_step  # policy version before the weight update
                     with self.policy_lock:
@@ -600,22 +758,43 @@ class LearnerWorker:
 
                     num_sgd_steps += 1
 
-                with torch.no_grad():
-                    with timing.add_time('after_optimizer'):
-                        self._after_optimizer_step()
+                with timing.add_time('after_optimizer'):
+                    self._after_optimizer_step()
 
-                        # collect and report summaries
-                        with_summaries = self._should_save_summaries() or force_summaries
-                        if with_summaries and not summary_this_epoch:
+                    # collect and report summaries
+                    if self._should_save_summaries() and not summary_this_epoch:
+                        with torch.no_grad():
                             stats_and_summaries = self._record_summaries(AttrDict(locals()))
-                            summary_this_epoch = True
-                            force_summaries = False
+                        summary_this_epoch = True
 
             # end of an epoch
             # this will force policy update on the inference worker (policy worker)
             self.policy_versions[self.policy_id] = self.train_step
 
-            new_epoch_actor_loss = np.mean(epoch_actor_losses)
+            # a single device sync per epoch: mean actor loss for early stopping, and the largest loss component
+            high_losses, high_loss_adv = high_loss_mb
+            epoch_losses = torch.cat((
+                torch.stack(epoch_actor_losses).mean().view(1), epoch_max_abs_loss.view(1), high_losses,
+            ))
+            new_epoch_actor_loss, max_abs_loss, *high_losses_list = epoch_losses.tolist()
+
+            high_loss = 30.0
+            if max_abs_loss > high_loss:
+                log.warning(
+                    'High loss value: %.4f %.4f %.4f %.4f (recommended to adjust the --reward_scale parameter)',
+                    *high_losses_list[:4],
+                )
+                if not summary_this_epoch:
+                    # losses and advantages in the summaries are those of the minibatch with the high loss,
+                    # the rest (values, entropy, gradients, etc.) are from the last minibatch of the epoch
+                    log.warning('Recording summaries: losses of the high loss minibatch, other stats of the last one')
+                    summary_vars = AttrDict(locals())
+                    summary_keys = ['loss', 'policy_loss', 'value_loss', 'entropy_loss', 'adv_std']
+                    summary_vars.update(zip(summary_keys, high_losses))
+                    summary_vars.adv = high_loss_adv
+                    with torch.no_grad():
+                        stats_and_summaries = self._record_summaries(summary_vars)
+
             loss_delta_abs = abs(prev_epoch_actor_loss - new_epoch_actor_loss)
             if loss_delta_abs < early_stopping_tolerance:
                 early_stop = True
@@ -627,6 +806,7 @@ class LearnerWorker:
 
             prev_epoch_actor_loss = new_epoch_actor_loss
             epoch_actor_losses = []
+            epoch_max_abs_loss = high_loss_mb = None
 
         return stats_and_summaries
 
@@ -636,12 +816,14 @@ class LearnerWorker:
         self.last_summary_time = time.time()
         stats = AttrDict()
 
-        grad_norm = sum(
-            p.grad.data.norm(2).item() ** 2
-            for p in self.actor_critic.parameters()
-            if p.grad is not None
-        ) ** 0.5
-        stats.grad_norm = grad_norm
+        if var.grad_norm is not None:
+            # total norm of the gradients before clipping was already calculated by clip_grad_norm_(),
+            # scale it the same way clip_grad_norm_() scales the gradients to report the norm after clipping
+            clip_coef = torch.clamp(self.cfg.max_grad_norm / (var.grad_norm + 1e-6), max=1.0)
+            stats.grad_norm = var.grad_norm * clip_coef
+        else:
+            grads = [p.grad.detach() for p in self.actor_critic_params if p.grad is not None]
+            stats.grad_norm = torch.stack([g.norm(2) for g in grads]).norm(2) if grads else 0.0
         stats.loss = var.loss
         stats.value = var.result.values.mean()
         stats.entropy = var.action_distribution.entropy().mean()
@@ -683,18 +865,25 @@ class LearnerWorker:
             stats.num_sgd_steps = var.num_sgd_steps
 
         # this caused numerical issues on some versions of PyTorch with second moment reaching infinity
-        adam_max_second_moment = 0.0
-        for key, tensor_state in self.optimizer.state.items():
-            adam_max_second_moment = max(tensor_state['exp_avg_sq'].max().item(), adam_max_second_moment)
-        stats.adam_max_second_moment = adam_max_second_moment
+        # Adam updates its state in-place, so the list of tensors only changes when new state entries are created
+        # or the optimizer state is loaded from a checkpoint
+        if self.adam_second_moments is None or len(self.adam_second_moments) != len(self.optimizer.state):
+            self.adam_second_moments = [tensor_state['exp_avg_sq'] for tensor_state in self.optimizer.state.values()]
+        second_moments = [exp_avg_sq.max() for exp_avg_sq in self.adam_second_moments]
+        stats.adam_max_second_moment = torch.stack(second_moments).max() if second_moments else 0.0
 
         version_diff = var.curr_policy_version - var.mb.policy_version
         stats.version_diff_avg = version_diff.mean()
         stats.version_diff_min = version_diff.min()
         stats.version_diff_max = version_diff.max()
 
-        for key, value in stats.items():
-            stats[key] = to_scalar(value)
+        # transfer all tensor stats to the CPU at once, instead of doing a device sync for every individual value
+        tensor_keys = [key for key, value in stats.items() if isinstance(value, torch.Tensor)]
+        if tensor_keys:
+            tensor_values = torch.cat([stats[key].detach().float().to(self.device).view(-1) for key in tensor_keys])
+            assert len(tensor_values) == len(tensor_keys), 'All summaries are expected to be scalars'
+            for key, value in zip(tensor_keys, tensor_values.cpu().tolist()):
+                stats[key] = value
 
         return stats
 
@@ -745,6 +934,7 @@ class LearnerWorker:
             self.env_steps = checkpoint_dict['env_steps']
         self.actor_critic.load_state_dict(checkpoint_dict['model'])
         self.optimizer.load_state_dict(checkpoint_dict['optimizer'])
+        self.adam_second_moments = None
         log.info('Loaded experiment state at training iteration %d, env step %d', self.train_step, self.env_steps)
 
     def init_model(self, timing):
@@ -752,6 +942,10 @@ class LearnerWorker:
         self.actor_critic.model_to_device(self.device)
         self.actor_critic.share_memory()
 
+        # parameters() walks the whole module tree, so we do it only once. The parameter objects stay the same
+        # for the lifetime of the model (load_state_dict() copies the data in-place)
+        self.actor_critic_params = list(self.actor_critic.parameters())
+
     def load_from_checkpoint(self, policy_id):
         checkpoints = self.get_checkpoints(self.checkpoint_dir(self.cfg, policy_id))
         checkpoint_dict = self.load_checkpoint(checkpoints, self.device)
@@ -784,18 +978,22 @@ class LearnerWorker:
                 # we should already see only one CUDA device, because of env vars
                 assert torch.cuda.device_count() == 1
                 self.device = torch.device('cuda', index=0)
+                # high priority (lower number), so the short copy/GAE kernels for the next batch are scheduled
+                # ahead of the long-running training kernels on the default stream
+                self.copy_stream = torch.cuda.Stream(device=self.device, priority=-1)
             else:
                 self.device = torch.device('cpu')
             self.init_model(timing)
 
             self.optimizer = torch.optim.Adam(
-                self.actor_critic.parameters(),
+                self.actor_critic_params,
                 self.cfg.learning_rate,
                 betas=(self.cfg.adam_beta1, self.cfg.adam_beta2),
                 eps=self.cfg.adam_eps,
             )
 
             self.load_from_checkpoint(self.policy_id)
+            self.save_thread.start()
 
             self._broadcast_model_weights()  # sync the very first version of the weights
 
@@ -803,65 +1001,129 @@ class LearnerWorker:
 
     def _process_training_data(self, data, timing, wait_stats=None):
         self.is_training = True
+        self.num_buffers_dequeued += 1
 
-        buffer, batch_size, samples, env_steps = data
+        buffer, episode_boundaries, batch_size, samples, env_steps, buffer_ready_event = data
         assert samples == batch_size * self.cfg.num_batches_per_iteration
 
+        if buffer_ready_event is not None:
+            # the buffer was prepared on the copy stream, make sure training ops are queued after it is ready
+            # and that the memory is not reused by the caching allocator while we're still training on it
+            current_stream = torch.cuda.current_stream()
+            current_stream.wait_event(buffer_ready_event)
+            for _, _, t in iterate_recursively(buffer):
+                t.record_stream(current_stream)
+
         self.env_steps += env_steps
         experience_size = buffer.rewards.shape[0]
 
-        stats = dict(learner_env_steps=self.env_steps, policy_id=self.policy_id)
+        stats = {'learner_env_steps': self.env_steps, 'policy_id': self.policy_id}
 
         with timing.add_time('train'):
-            discarding_rate = self._discarding_rate()
+            discarding_rate = self.discarding_rate
 
             self._update_pbt()
 
-            train_stats = self._train(buffer, batch_size, experience_size, timing)
+            train_stats = self._train(buffer, episode_boundaries, batch_size, experience_size, timing)
 
             if train_stats is not None:
-                stats['train'] = train_stats
-
+                # train_stats is a fresh dict created by _record_summaries(), so we just add the extra stats to it
+                # instead of building any intermediate dictionaries
                 if wait_stats is not None:
-                    wait_avg, wait_min, wait_max = wait_stats
-                    stats['train']['wait_avg'] = wait_avg
-                    stats['train']['wait_min'] = wait_min
-                    stats['train']['wait_max'] = wait_max
+                    train_stats['wait_avg'], train_stats['wait_min'], train_stats['wait_max'] = wait_stats
 
-                stats['train']['discarded_rollouts'] = self.num_discarded_rollouts
-                stats['train']['discarding_rate'] = discarding_rate
+                train_stats['discarded_rollouts'] = self.num_discarded_rollouts
+                train_stats['discarding_rate'] = discarding_rate
 
+                stats['train'] = train_stats
                 stats['stats'] = memory_stats('learner', self.device)
 
         self.is_training = False
 
+        self._report_stats(stats)
+
+    def _release_experience_without_training(self, train_data):
+        """
+        Debugging no-training regime: trajectory buffers are given back to the actors right away, without
+        extracting the rollouts. We still count env steps, so the experiment terminates as usual.
+        """
+        for data in train_data:
+            traj_tensors_available = self.traj_tensors_available[data['worker_idx'], data['split_idx']]
+            traj_tensors_available[data['env_idx'], data['agent_idx'], data['traj_buffer_idx']] = 1
+            self.env_steps += int(data['env_steps'].sum())
+
+        self._report_stats({'learner_env_steps': self.env_steps, 'policy_id': self.policy_id})
+
+    def _report_stats(self, stats):
+        self.pending_reports.append(stats)
+        if time.time() - self.last_reports_flush >= self.reports_flush_interval:
+            self._flush_reports()
+
+    def _flush_reports(self):
+        if not self.pending_reports:
+            return
+
         try:
-            self.report_queue.put(stats)
+            self.report_queue.put(self.pending_reports)
         except Full:
             log.warning('Could not report training stats, the report queue is full!')
 
+        self.pending_reports = []
+        self.last_reports_flush = time.time()
+
+    def _request_cache_cleanup(self):
+        if not self.cache_cleanup_thread.is_alive():
+            self.cache_cleanup_thread.start()
+
+        # the cleanup thread only waits for the work queued so far, the training can continue in the meantime
+        cache_cleanup_after = torch.cuda.Event()
+        cache_cleanup_after.record()
+        self.cache_cleanup_after = cache_cleanup_after
+        self.cache_cleanup_requested.set()
+
+    def _cache_cleanup_loop(self):
+        while True:
+            self.cache_cleanup_requested.wait()
+            self.cache_cleanup_requested.clear()
+
+            cache_cleanup_after = self.cache_cleanup_after
+            if cache_cleanup_after is None:
+                break
+
+            cache_cleanup_after.synchronize()
+            # explicit device context, otherwise this can create a context on cuda:0
+            with torch.cuda.device(self.device):
+                torch.cuda.empty_cache()
+
+    def _stop_cache_cleanup_thread(self):
+        if self.cache_cleanup_thread.is_alive():
+            self.cache_cleanup_after = None
+            self.cache_cleanup_requested.set()
+            self.cache_cleanup_thread.join()
+
     def _train_loop(self):
         timing = Timing()
         self.initialize(timing)
 
-        wait_times = deque([], maxlen=self.cfg.num_workers)
-        last_cache_cleanup = time.time()
-        num_batches_processed = 0
+        wait_times = SlidingWindowStats(self.cfg.num_workers)
+
+        cache_monitor = None
+        if self.cfg.device == 'gpu':
+            cache_monitor = CudaCacheMonitor(torch.cuda.get_device_properties(self.device).total_memory)
 
         while not self.terminate:
             with timing.timeit('train_wait'):
-                data = safe_get(self.experience_buffer_queue)
+                # block until the next buffer is ready, None is put into the queue when the learner terminates
+                data = self.experience_buffer_queue.get()
 
-            if self.terminate:
+            if data is None or self.terminate:
                 break
 
             wait_stats = None
-            wait_times.append(timing.train_wait)
+            wait_times.add(timing.train_wait)
 
-            if len(wait_times) >= wait_times.maxlen:
-                wait_times_arr = np.asarray(wait_times)
-                wait_avg = np.mean(wait_times_arr)
-                wait_min, wait_max = wait_times_arr.min(), wait_times_arr.max()
+            if len(wait_times) >= wait_times.window_size:
+                wait_avg, wait_min, wait_max = wait_times.mean(), wait_times.min(), wait_times.max()
                 # log.debug(
                 #     'Training thread had to wait %.5f s for the new experience buffer (avg %.5f)',
                 #     timing.train_wait, wait_avg,
@@ -869,13 +1131,24 @@ class LearnerWorker:
                 wait_stats = (wait_avg, wait_min, wait_max)
 
             self._process_training_data(data, timing, wait_stats)
-            num_batches_processed += 1
 
-            if time.time() - last_cache_cleanup > 300.0 or (not self.cfg.benchmark and num_batches_processed < 50):
-                if self.cfg.device == 'gpu':
-                    torch.cuda.empty_cache()
-                    torch.cuda.ipc_collect()
-                last_cache_cleanup = time.time()
+            if cache_monitor is not None:
+                # batch shapes are fixed, so cached blocks are reused anyway. Only give the memory back when
+                # the allocator cache is persistently fragmented
+                reserved = torch.cuda.memory_reserved(self.device)
+                allocated = torch.cuda.memory_allocated(self.device)
+                if cache_monitor.should_release_cache(reserved, allocated):
+                    self._request_cache_cleanup()
+
+        self._flush_reports()
+
+        if self.cfg.device == 'gpu':
+            self._stop_cache_cleanup_thread()
+
+            # release CUDA IPC memory handles no longer used by other processes
+            # weights are shared with the policy workers only once (see _broadcast_model_weights()) and stay in use
+            # for the whole experiment, so there is nothing to collect before this point
+            torch.cuda.ipc_collect()
 
         time.sleep(0.3)
         log.info('Train loop timing: %s', timing)
@@ -888,32 +1161,32 @@ class LearnerWorker:
             self.discarded_experience_timer = now
             self.discarded_experience_over_time.append((now, self.num_discarded_rollouts))
 
-    def _discarding_rate(self):
-        if len(self.discarded_experience_over_time) <= 1:
-            return 0
-
-        first, last = self.discarded_experience_over_time[0], self.discarded_experience_over_time[-1]
-        delta_rollouts = last[1] - first[1]
-        delta_time = last[0] - first[0]
-        discarding_rate = delta_rollouts / (delta_time + EPS)
-        return discarding_rate
+            first, last = self.discarded_experience_over_time[0], self.discarded_experience_over_time[-1]
+            delta_rollouts = last[1] - first[1]
+            delta_time = last[0] - first[0]
+            self.discarding_rate = delta_rollouts / (delta_time + EPS)
 
-    def _extract_rollouts(self, data):
-        data = AttrDict(data)
-        worker_idx, split_idx, traj_buffer_idx = data.worker_idx, data.split_idx, data.traj_buffer_idx
+    def _extract_rollouts(self, train_data):
+        """
+        Parse experience from a list of TRAIN messages, each of them corresponds to a single actor worker split.
+        Each message contains per-rollout arrays, so we only compute the indices of the trajectories in the shared
+        buffers with vector ops, everything else (worker, split, etc.) can be recovered from these indices.
+        """
+        worker_stride, split_stride, env_stride, agent_stride, traj_buffer_stride = self.traj_buffers_strides
 
-        rollouts = []
-        for rollout_data in data.rollouts:
-            env_idx, agent_idx = rollout_data['env_idx'], rollout_data['agent_idx']
-            tensors = self.rollout_tensors.index((worker_idx, split_idx, env_idx, agent_idx, traj_buffer_idx))
+        traj_idx, length, env_steps = [], [], []
+        for data in train_data:
+            worker_idx, split_idx, traj_buffer_idx = data['worker_idx'], data['split_idx'], data['traj_buffer_idx']
+            base_traj_idx = worker_idx * worker_stride + split_idx * split_stride + traj_buffer_idx * traj_buffer_stride
 
-            rollout_data['t'] = tensors
-            rollout_data['worker_idx'] = worker_idx
-            rollout_data['split_idx'] = split_idx
-            rollout_data['traj_buffer_idx'] = traj_buffer_idx
-            rollouts.append(AttrDict(rollout_data))
+            # indices of these trajectories in the flattened shared trajectory tensors
+            traj_idx.append(base_traj_idx + data['env_idx'] * env_stride + data['agent_idx'] * agent_stride)
+            length.append(data['length'])
+            env_steps.append(data['env_steps'])
 
-        return rollouts
+        return Rollouts(
+            np.concatenate(traj_idx), np.concatenate(length), np.concatenate(env_steps),
+        )
 
     def _process_pbt_task(self, pbt_task):
         task_type, data = pbt_task
@@ -950,7 +1223,8 @@ class LearnerWorker:
         minibatches_currently_accumulated = len(rollouts) / rollouts_per_minibatch
 
         # count minibatches ready for training
-        minibatches_currently_accumulated += self.experience_buffer_queue.qsize() * self.cfg.num_batches_per_iteration
+        num_buffers_ready = self.num_buffers_enqueued - self.num_buffers_dequeued
+        minibatches_currently_accumulated += num_buffers_ready * self.cfg.num_batches_per_iteration
 
         total_minibatches_on_learner = minibatches_currently_training + minibatches_currently_accumulated
 
@@ -973,7 +1247,7 @@ class LearnerWorker:
 
         timing = Timing()
 
-        rollouts = []
+        rollouts = Rollouts()
 
         if self.train_in_background:
             self.training_thread.start()
@@ -988,11 +1262,12 @@ class LearnerWorker:
                 try:
                     tasks = self.task_queue.get_many(timeout=0.005)
 
+                    # accumulate experience from all messages we've got, to extract it at once
+                    train_data = []
+
                     for task_type, data in tasks:
                         if task_type == TaskType.TRAIN:
-                            with timing.add_time('extract'):
-                                rollouts.extend(self._extract_rollouts(data))
-                                # log.debug('Learner %d has %d rollouts', self.policy_id, len(rollouts))
+                            train_data.append(data)
                         elif task_type == TaskType.INIT:
                             self._init()
                         elif task_type == TaskType.TERMINATE:
@@ -1002,6 +1277,13 @@ class LearnerWorker:
                             break
                         elif task_type == TaskType.PBT:
                             self._process_pbt_task(data)
+
+                    if train_data and not self.with_training:
+                        self._release_experience_without_training(train_data)
+                    elif train_data:
+                        with timing.add_time('extract'):
+                            rollouts.extend(self._extract_rollouts(train_data))
+                            # log.debug('Learner %d has %d rollouts', self.policy_id, len(rollouts))
                 except Empty:
                     break
 
@@ -1042,6 +1324,11 @@ class LearnerWorker:
         if self.train_in_background:
             self.experience_buffer_queue.put(None)
             self.training_thread.join()
+        else:
+            self._flush_reports()
+
+        # make sure all pending checkpoints are written to disk
+        self._stop_save_thread()
 
     def init(self):
         self.task_queue.put((TaskType.INIT, None))
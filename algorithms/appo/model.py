@@ -43,22 +43,22 @@ class _ActorCriticBase(nn.Module):
             if type(layer) == nn.Conv2d or type(layer) == nn.Linear:
                 nn.init.orthogonal_(layer.weight.data, gain=gain)
                 layer.bias.data.fill_(0)
-            elif type(layer) == nn.GRUCell or type(layer) == nn.LSTMCell:  # TODO: test for LSTM
-                nn.init.orthogonal_(layer.weight_ih, gain=gain)
-                nn.init.orthogonal_(layer.weight_hh, gain=gain)
-                layer.bias_ih.data.fill_(0)
-                layer.bias_hh.data.fill_(0)
+            elif type(layer) == nn.GRU or type(layer) == nn.LSTM:  # TODO: test for LSTM
+                nn.init.orthogonal_(layer.weight_ih_l0, gain=gain)
+                nn.init.orthogonal_(layer.weight_hh_l0, gain=gain)
+                layer.bias_ih_l0.data.fill_(0)
+                layer.bias_hh_l0.data.fill_(0)
             else:
                 pass
         elif self.cfg.policy_initialization == 'xavier_uniform':
             if type(layer) == nn.Conv2d or type(layer) == nn.Linear:
                 nn.init.xavier_uniform_(layer.weight.data, gain=gain)
                 layer.bias.data.fill_(0)
-            elif type(layer) == nn.GRUCell or type(layer) == nn.LSTMCell:
-                nn.init.xavier_uniform_(layer.weight_ih, gain=gain)
-                nn.init.xavier_uniform_(layer.weight_hh, gain=gain)
-                layer.bias_ih.data.fill_(0)
-                layer.bias_hh.data.fill_(0)
+            elif type(layer) == nn.GRU or type(layer) == nn.LSTM:
+                nn.init.xavier_uniform_(layer.weight_ih_l0, gain=gain)
+                nn.init.xavier_uniform_(layer.weight_hh_l0, gain=gain)
+                layer.bias_ih_l0.data.fill_(0)
+                layer.bias_hh_l0.data.fill_(0)
             else:
                 pass
 
@@ -91,6 +91,10 @@ class _ActorCriticSharedWeights(_ActorCriticBase):
         x, new_rnn_states = self.core(head_output, rnn_states)
         return x, new_rnn_states
 
+    def forward_core_sequence(self, head_outputs, rnn_states):
+        """Core outputs for a [T, Batch, D] sequence without episode boundaries, see PolicyCoreRNN.forward_sequence()."""
+        return self.core.forward_sequence(head_outputs, rnn_states)
+
     def forward_tail(self, core_output, with_action_distribution=False):
         values = self.critic_linear(core_output)
 
@@ -179,6 +183,18 @@ class _ActorCriticSeparateWeights(_ActorCriticBase):
     def forward_core(self, head_output, rnn_states):
         return self.core_func(head_output, rnn_states)
 
+    def forward_core_sequence(self, head_outputs, rnn_states):
+        """Core outputs for a [T, Batch, D] sequence without episode boundaries, see PolicyCoreRNN.forward_sequence()."""
+        if not self.cfg.use_rnn:
+            return head_outputs
+
+        num_cores = len(self.cores)
+        head_outputs_split = head_outputs.chunk(num_cores, dim=2)
+        rnn_states_split = rnn_states.chunk(num_cores, dim=1)
+
+        outputs = [c.forward_sequence(head_outputs_split[i], rnn_states_split[i]) for i, c in enumerate(self.cores)]
+        return torch.cat(outputs, dim=2)
+
     def forward_tail(self, core_output, with_action_distribution=False):
         core_outputs = core_output.chunk(len(self.cores), dim=1)
 
@@ -313,26 +313,51 @@ class PolicyCoreRNN(PolicyCoreBase):
         self.cfg = cfg
         self.is_gru = False
 
+        # single-layer nn.GRU/nn.LSTM instead of a cell, so the whole BPTT sequence can be processed in one
+        # call. On GPU the weights are kept in a single flat cuDNN buffer (nn.GRU/nn.LSTM call flatten_parameters()
+        # when moved to the device), so they are not copied on every call
         if cfg.rnn_type == 'gru':
-            self.core = nn.GRUCell(input_size, cfg.hidden_size)
+            self.core = nn.GRU(input_size, cfg.hidden_size)
             self.is_gru = True
         elif cfg.rnn_type == 'lstm':
-            self.core = nn.LSTMCell(input_size, cfg.hidden_size)
+            self.core = nn.LSTM(input_size, cfg.hidden_size)
         else:
             raise RuntimeError(f'Unknown RNN type {cfg.rnn_type}')
 
         self.core_output_size = cfg.hidden_size
 
-    def forward(self, head_output, rnn_states):
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved with the nn.GRUCell/nn.LSTMCell core have the same weights under different names
+        for name in ('weight_ih', 'weight_hh', 'bias_ih', 'bias_hh'):
+            cell_key = f'{prefix}core.{name}'
+            if cell_key in state_dict:
+                state_dict[f'{cell_key}_l0'] = state_dict.pop(cell_key)
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _forward_rnn(self, inputs, rnn_states):
         if self.is_gru:
-            x = new_rnn_states = self.core(head_output, rnn_states)
+            outputs, h = self.core(inputs, rnn_states.unsqueeze(0).contiguous())
+            new_rnn_states = h.squeeze(0)
         else:
             h, c = torch.split(rnn_states, self.cfg.hidden_size, dim=1)
-            h, c = self.core(head_output, (h, c))
-            x = h
-            new_rnn_states = torch.cat((h, c), dim=1)
+            outputs, (h, c) = self.core(inputs, (h.unsqueeze(0).contiguous(), c.unsqueeze(0).contiguous()))
+            new_rnn_states = torch.cat((h.squeeze(0), c.squeeze(0)), dim=1)
 
-        return x, new_rnn_states
+        return outputs, new_rnn_states
+
+    def forward(self, head_output, rnn_states):
+        x, new_rnn_states = self._forward_rnn(head_output.unsqueeze(0), rnn_states)
+        return x.squeeze(0), new_rnn_states
+
+    def forward_sequence(self, head_outputs, rnn_states):
+        """
+        Process a whole [T, Batch, D] sequence in a single RNN call (cuDNN on GPU). Equivalent to calling forward()
+        T times, but only valid if the RNN states should not be reset anywhere within the sequence.
+        :return: core outputs [T, Batch, hidden_size]
+        """
+        outputs, _ = self._forward_rnn(head_outputs, rnn_states)
+        return outputs
 
 
 class PolicyCoreFeedForward(PolicyCoreBase):
@@ -346,6 +371,9 @@ class PolicyCoreFeedForward(PolicyCoreBase):
     def forward(self, head_output, fake_rnn_states):
         return head_output, fake_rnn_states
 
+    def forward_sequence(self, head_outputs, fake_rnn_states):
+        return head_outputs
+
 
 def create_core(cfg, core_input_size):
     if cfg.use_rnn:
@@ -94,8 +94,9 @@ class SharedBuffers:
 
         # this is for performance optimization
         # indexing in numpy arrays is faster than in PyTorch tensors
+        # (the learner gathers whole trajectories directly from the flattened tensors, so it does not need
+        # a similar array of per-trajectory views)
         self.tensors_individual_transitions = self.tensor_dict_to_numpy(len(self.tensor_dimensions()))
-        self.tensor_trajectories = self.tensor_dict_to_numpy(len(self.tensor_dimensions()) - 1)
 
         # create a shared tensor to indicate when the learner is done with the trajectory buffer and
         # it can be used to store the next trajectory
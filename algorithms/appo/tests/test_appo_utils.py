@@ -0,0 +1,27 @@
+from unittest import TestCase
+
+from algorithms.appo.appo_utils import CudaCacheMonitor
+
+
+class TestAppoUtils(TestCase):
+    def test_cuda_cache_monitor(self):
+        gb = 1024 ** 3
+        monitor = CudaCacheMonitor(total_memory=10 * gb, warmup_steps=5, persistent_steps=3)
+
+        # warmup, this determines the baseline
+        for _ in range(5):
+            self.assertFalse(monitor.should_release_cache(reserved=2 * gb, allocated=1 * gb))
+
+        # steady state, or short spikes, should not trigger the cleanup
+        for _ in range(10):
+            self.assertFalse(monitor.should_release_cache(reserved=4 * gb, allocated=1 * gb))
+            self.assertFalse(monitor.should_release_cache(reserved=2 * gb, allocated=1 * gb))
+
+        # a lot of cached memory is not allocated for a few steps in a row
+        self.assertFalse(monitor.should_release_cache(reserved=4 * gb, allocated=1 * gb))
+        self.assertFalse(monitor.should_release_cache(reserved=4 * gb, allocated=1 * gb))
+        self.assertTrue(monitor.should_release_cache(reserved=4 * gb, allocated=1 * gb))
+
+        # a lot of memory is reserved, but it is actually used
+        for _ in range(10):
+            self.assertFalse(monitor.should_release_cache(reserved=4 * gb, allocated=3.5 * gb))
@@ -0,0 +1,91 @@
+from unittest import TestCase
+
+import numpy as np
+import torch
+
+from algorithms.appo.learner import LearnerWorker
+from algorithms.utils.algo_utils import calculate_gae
+from utils.utils import AttrDict
+
+
+class TestLearner(TestCase):
+    @staticmethod
+    def _grad(loss_func, x, *args):
+        x = x.clone().requires_grad_()
+        loss_func(x, *args).backward()
+        return x.grad
+
+    def test_policy_loss_gradients(self):
+        clip_ratio_high = 1.1
+        clip_ratio_low = 1.0 / clip_ratio_high
+
+        # ratios inside and outside of the clipping range
+        ratio = torch.tensor([0.5, 0.95, 1.0, 1.05, 2.0, 0.99, 1.01, 1.02])
+        adv = torch.tensor([1.0, -1.0, 2.0, 0.5, 1.0, 1.0, -2.0, 3.0])
+
+        # the pessimistic (min) surrogate is the unclipped one everywhere except ratio=2.0 with a positive advantage,
+        # where the clipped surrogate is constant
+        expected = -adv / len(ratio)
+        expected[4] = 0.0
+
+        # loss functions must produce the correct gradients every time, not just on the first call
+        for _ in range(5):
+            grad = self._grad(LearnerWorker._policy_loss, ratio, adv, clip_ratio_low, clip_ratio_high)
+            self.assertTrue(torch.allclose(grad, expected))
+
+    def test_value_loss_gradients(self):
+        learner = AttrDict(cfg=AttrDict(value_loss_coeff=0.5))
+        clip_value = 0.2
+
+        old_values = torch.zeros(6)
+        new_values = torch.tensor([-0.1, 0.0, 0.1, 0.15, 1.0, -1.0])
+        targets = torch.tensor([1.0, 1.0, -1.0, 0.5, 0.0, 0.0])
+
+        # the unclipped loss is the larger one for all of these values, so the gradient is that of the unclipped loss
+        expected = 2.0 * (new_values - targets) * learner.cfg.value_loss_coeff / len(new_values)
+        for _ in range(5):
+            grad = self._grad(
+                lambda v: LearnerWorker._value_loss(learner, v, old_values, targets, clip_value), new_values,
+            )
+            self.assertTrue(torch.allclose(grad, expected))
+
+    def test_gae_matches_numpy(self):
+        num_envs, rollout = 7, 16
+        learner = AttrDict(cfg=AttrDict(rollout=rollout, gamma=0.99, gae_lambda=0.95))
+
+        # learner buffers are [E x T], flattened
+        rewards = torch.randn(num_envs * rollout)
+        dones = (torch.rand(num_envs * rollout) < 0.1).float()
+        values = torch.randn(num_envs * rollout)
+        buffer = AttrDict(rewards=rewards, dones=dones, values=values)
+        buffer = LearnerWorker._calculate_gae(learner, buffer)
+
+        # numpy reference works with [T, E] arrays, and needs the value of the state after the last step
+        rewards_tn, dones_tn, values_tn = (x.view(num_envs, rollout).t().numpy() for x in (rewards, dones, values))
+        next_values = (values_tn[-1] - rewards_tn[-1]) / learner.cfg.gamma
+        values_tn = np.concatenate((values_tn, next_values[np.newaxis]))
+        advantages, returns = calculate_gae(
+            rewards_tn, dones_tn, values_tn, learner.cfg.gamma, learner.cfg.gae_lambda,
+        )
+
+        self.assertTrue(np.allclose(buffer.advantages.view(num_envs, rollout).t().numpy(), advantages, atol=1e-5))
+        self.assertTrue(np.allclose(buffer.returns.view(num_envs, rollout).t().numpy(), returns, atol=1e-5))
+
+    def test_minibatch_segments(self):
+        recurrence, batch_size, experience_size = 4, 16, 64
+        learner = AttrDict(
+            cfg=AttrDict(rollout=8, recurrence=recurrence, num_batches_per_iteration=experience_size // batch_size),
+            device=torch.device('cpu'),
+        )
+
+        minibatches = LearnerWorker._get_minibatches(learner, batch_size, experience_size)
+        self.assertEqual(len(minibatches), experience_size // batch_size)
+
+        all_segments = []
+        for indices, segments in minibatches:
+            # host segment indices describe exactly the samples selected on the device
+            expected_indices = (segments[:, np.newaxis] * recurrence + np.arange(recurrence)).reshape(-1)
+            self.assertTrue(np.array_equal(indices.numpy(), expected_indices))
+            all_segments.extend(segments)
+
+        self.assertEqual(sorted(all_segments), list(range(experience_size // recurrence)))
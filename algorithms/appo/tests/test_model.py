@@ -2,9 +2,10 @@ import unittest
 from unittest import TestCase
 
 import torch
+from torch import nn
 
 from algorithms.appo.model import create_actor_critic
-from algorithms.appo.model_utils import get_hidden_size
+from algorithms.appo.model_utils import get_hidden_size, PolicyCoreRNN
 from algorithms.utils.arguments import default_cfg
 from envs.create_env import create_env
 from utils.timing import Timing
@@ -53,3 +54,56 @@ class TestModel(TestCase):
     @unittest.skipUnless(torch.cuda.is_available(), 'This test requires a GPU')
     def test_forward_pass_gpu(self):
         self.forward_pass('cuda')
+
+    def rnn_core_sequence(self, device_type):
+        cfg = default_cfg(algo='APPO', env='atari_breakout')
+        cfg.hidden_size = 32
+        seq_len, batch, input_size = 8, 16, 24
+        device = torch.device(device_type)
+
+        # cuDNN may use TF32 math on recent GPUs
+        atol = 1e-5 if device_type == 'cpu' else 1e-3
+
+        for rnn_type in ['gru', 'lstm']:
+            cfg.rnn_type = rnn_type
+
+            # reference: RNN cell applied step by step, the core loads the weights from a cell checkpoint
+            cell_type = nn.GRUCell if rnn_type == 'gru' else nn.LSTMCell
+            cell = cell_type(input_size, cfg.hidden_size)
+            core = PolicyCoreRNN(cfg, input_size)
+            core.load_state_dict({f'core.{k}': v for k, v in cell.state_dict().items()})
+            cell.to(device)
+            core.to(device)
+
+            head_outputs = torch.rand([seq_len, batch, input_size], device=device)
+            rnn_states = torch.rand([batch, get_hidden_size(cfg)], device=device)
+
+            core_outputs = core.forward_sequence(head_outputs, rnn_states)
+
+            expected_outputs = []
+            step_rnn_states = rnn_states
+            for i in range(seq_len):
+                core_output, step_rnn_states = core(head_outputs[i], step_rnn_states)
+                expected_outputs.append(core_output)
+
+                if rnn_type == 'gru':
+                    cell_h = cell(head_outputs[i], rnn_states)
+                    rnn_states = cell_h
+                else:
+                    cell_h, cell_c = cell(head_outputs[i], torch.split(rnn_states, cfg.hidden_size, dim=1))
+                    rnn_states = torch.cat((cell_h, cell_c), dim=1)
+
+                self.assertTrue(torch.allclose(core_output, cell_h, atol=atol))
+                self.assertTrue(torch.allclose(step_rnn_states, rnn_states, atol=atol))
+
+            expected_outputs = torch.stack(expected_outputs)
+
+            self.assertEqual(core_outputs.shape, expected_outputs.shape)
+            self.assertTrue(torch.allclose(core_outputs, expected_outputs, atol=atol))
+
+    def test_rnn_core_sequence_cpu(self):
+        self.rnn_core_sequence('cpu')
+
+    @unittest.skipUnless(torch.cuda.is_available(), 'This test requires a GPU')
+    def test_rnn_core_sequence_gpu(self):
+        self.rnn_core_sequence('cuda')
@@ -13,3 +13,19 @@ def to_scalar(value):
         return value.item()
     else:
         return value
+
+
+def to_cpu_copy(x, non_blocking=False):
+    """
+    Recursively copy all tensors in a (possibly nested) structure of dicts/lists/tuples to CPU memory.
+    The result does not share memory with the original tensors, so it can be used while they are being modified.
+    With non_blocking=True device-to-host copies are asynchronous, the caller should synchronize before using result.
+    """
+    if isinstance(x, torch.Tensor):
+        return x.detach().to('cpu', copy=True, non_blocking=non_blocking)
+    elif isinstance(x, dict):
+        return type(x)((k, to_cpu_copy(v, non_blocking)) for k, v in x.items())
+    elif isinstance(x, (list, tuple)):
+        return type(x)(to_cpu_copy(v, non_blocking) for v in x)
+    else:
+        return x
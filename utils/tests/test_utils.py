@@ -1,5 +1,9 @@
+from collections import deque
 from unittest import TestCase
-from utils.utils import cores_for_worker_process
+
+import numpy as np
+
+from utils.utils import cores_for_worker_process, SlidingWindowStats
 from utils.network import is_udp_port_available
 
 
@@ -24,4 +28,16 @@ class TestUtils(TestCase):
             elif i == 43:
                 self.assertEqual(cores, [15, 16, 17, 18, 19])
 
+    def test_sliding_window_stats(self):
+        window_size = 7
+        stats = SlidingWindowStats(window_size)
+        window = deque([], maxlen=window_size)
+
+        for value in np.random.normal(size=100):
+            stats.add(value)
+            window.append(value)
 
+            self.assertEqual(len(stats), len(window))
+            self.assertAlmostEqual(stats.mean(), np.mean(window))
+            self.assertEqual(stats.min(), min(window))
+            self.assertEqual(stats.max(), max(window))
@@ -24,7 +24,7 @@ class TimingContext:
         self._time_enter = None
 
     def __enter__(self):
-        self._time_enter = time.time()
+        self._time_enter = time.perf_counter()
 
     def __exit__(self, type_, value, traceback):
         if self._key not in self._timer:
@@ -33,7 +33,7 @@ class TimingContext:
             else:
                 self._timer[self._key] = 0
 
-        time_passed = max(time.time() - self._time_enter, EPS)  # EPS to prevent div by zero
+        time_passed = max(time.perf_counter() - self._time_enter, EPS)  # EPS to prevent div by zero
 
         if self._additive:
             self._timer[self._key] += time_passed
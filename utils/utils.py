@@ -8,6 +8,7 @@ import os
 import pwd
 import tempfile
 from _queue import Empty
+from collections import deque
 from os.path import join
 from sys import platform
 
@@ -105,6 +106,61 @@ def static_vars(**kwargs):
     return decorate
 
 
+class SlidingWindowStats:
+    """
+    Mean, min and max of the last window_size values.
+    Values are kept in a ring buffer together with the running sum, and min/max are tracked with monotonic deques
+    of indices, so every operation is O(1) (amortized) and there are no allocations after construction.
+    """
+
+    def __init__(self, window_size):
+        assert window_size > 0
+        self.window_size = window_size
+        self.values = np.zeros(window_size, dtype=np.float64)
+        self.num_added = 0
+        self.sum = 0.0
+
+        # indices of values in the window, corresponding values are increasing (min) and decreasing (max)
+        self.min_indices = deque()
+        self.max_indices = deque()
+
+    def __len__(self):
+        return min(self.num_added, self.window_size)
+
+    def add(self, value):
+        idx = self.num_added
+        pos = idx % self.window_size
+
+        if idx >= self.window_size:
+            # the oldest value leaves the window
+            self.sum -= self.values[pos]
+            oldest_idx = idx - self.window_size
+            if self.min_indices[0] == oldest_idx:
+                self.min_indices.popleft()
+            if self.max_indices[0] == oldest_idx:
+                self.max_indices.popleft()
+
+        while self.min_indices and self.values[self.min_indices[-1] % self.window_size] >= value:
+            self.min_indices.pop()
+        while self.max_indices and self.values[self.max_indices[-1] % self.window_size] <= value:
+            self.max_indices.pop()
+
+        self.values[pos] = value
+        self.sum += value
+        self.min_indices.append(idx)
+        self.max_indices.append(idx)
+        self.num_added += 1
+
+    def mean(self):
+        return self.sum / len(self)
+
+    def min(self):
+        return self.values[self.min_indices[0] % self.window_size]
+
+    def max(self):
+        return self.values[self.max_indices[0] % self.window_size]
+
+
 def safe_get(q, timeout=1e6, msg='Queue timeout'):
     """Using queue.get() with timeout is necessary, otherwise KeyboardInterrupt is not handled."""
     while True: